@@ -1,12 +1,45 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import argparse
+import errno
+import fcntl
 import fileinput
+import hashlib
+import multiprocessing
+import os
+import re
+import shutil
 import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from multiprocessing.pool import ThreadPool
 
-db_conn = sqlite3.connect('invoice.db')
+import iv
+import pdfinvoice
+
+OUTPUT_DIR = 'output'
+
+# Prices include VAT (moms) of 25 %, which is 20 % of the price
+VAT_SHARE = Decimal('0.20')
+CENTS = Decimal('0.01')
+
+BEGIN_DOCUMENT = '\\begin{document}'
+# Rendered PDFs by SHA-1 of their LaTeX source
+CACHE_DIR = 'cache'
+# Bytes of LaTeX source collected before they are written to its file
+SOURCE_BUFFER = 64 * 1024
+
+# Only one daemon renders the queue of a database, the one holding
+# a lock on this file next to it
+DAEMON_LOCK = '%s.daemon-lock'
+
+# Use the same database and pragmas as iv.py
+db_conn = iv.db_pool.connect()
 db_cursor = db_conn.cursor()
 
 class product():
@@ -91,70 +124,631 @@ class product():
 #quit()
 
 
-date = datetime.now()
-dateStr = date.strftime('%Y-%m-%d')
-
-
-if len(sys.argv) < 2:
-    print "Usage: %s <orderid>" % sys.argv[0]
-    quit()
-
-orderId = int(sys.argv[1])
-
-db_cursor.execute("SELECT status, invoiceFile, created FROM orders WHERE id = %d" %
-        orderId)
-orderInfo = db_cursor.fetchone();
-
 """
 orders.status
   0 - not processed
   1 - sent
   2 - paid
-if orderInfo[0] == 0:
 """
 
+def parse_ids(spec):
+    """ Parse '10-500' or '3,7,10-20' into a list of (first, last) ranges """
+    ranges = []
+    for part in spec.split(','):
+        first, sep, last = part.partition('-')
+        ranges.append((int(first), int(last) if sep else int(first)))
+    return ranges
+
+def order_filter(args):
+    """ WHERE-clause on orders o for the selected orders, with parameters """
+    clauses = []
+    params = []
+    if args.orderid is not None:
+        clauses.append("o.id = ?")
+        params.append(args.orderid)
+    if args.ids is not None:
+        ranges = parse_ids(args.ids)
+        clauses.append("(%s)" % " OR ".join(["o.id BETWEEN ? AND ?"] * len(ranges)))
+        for r in ranges:
+            params.extend(r)
+    if args.status is not None:
+        clauses.append("o.status = ?")
+        params.append(args.status)
+    if args.all_unsent:
+        clauses.append("o.status = 0")
+    return " AND ".join(clauses), params
+
+def load_orders(where, params):
+    """ Customer info of all selected orders, in one query.
+        Returns a list of (orderId, customerInfo), the order lines
+        are read by order_lines() when the invoice is rendered
+    """
+    db_cursor.execute("""
+    SELECT o.id, name, reference, postcode, city, address1, address2
+    FROM orders o
+    LEFT JOIN customer c ON c.id = o.customerId
+    WHERE %s ORDER BY o.id""" % where, params)
+    return [(row[0], row[1:]) for row in db_cursor]
+
+def order_lines(orderId):
+    """ The lines of an order, as (name, price, count, comment).
+        They are read from the cursor while they are used, so even
+        orders with many thousands of lines are never held in memory
+    """
+    with iv.SQLite3DB() as db:
+        db.execute("""
+        SELECT p.name, op.price, op.count, op.comment FROM order_products op
+        LEFT JOIN products p ON p.id = op.productId
+        WHERE op.orderId = ? ORDER BY op.id""", (orderId,))
+        for row in db.c:
+            yield row
+
+def decimal(value):
+    """ Amounts come as Decimal through the converter registered in iv.py,
+        but columns written as REAL or left NULL need converting
+    """
+    if value is None:
+        return Decimal(0)
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+def amount(value):
+    return value.quantize(CENTS, ROUND_HALF_UP)
+
+# Characters with a special meaning to TeX, and how to typeset them
+TEX_SPECIALS = {
+    u'\\': u'\\textbackslash{}',
+    u'{': u'\\{',
+    u'}': u'\\}',
+    u'$': u'\\$',
+    u'&': u'\\&',
+    u'#': u'\\#',
+    u'%': u'\\%',
+    u'_': u'\\_',
+    u'^': u'\\textasciicircum{}',
+    u'~': u'\\textasciitilde{}',
+    u'"': u"$\\,''$",
+    # Not special, but come out as other glyphs in the OT1 encoding
+    u'<': u'\\textless{}',
+    u'>': u'\\textgreater{}',
+    u'|': u'\\textbar{}',
+    # Would be taken as the optional argument of the \\ ending the line
+    # before, e.g. a customer field starting with "[c/o"
+    u'[': u'{[}',
+    u']': u'{]}',
+    u'*': u'{*}',
+}
+TEX_SPECIAL = re.compile(u'[%s]' % re.escape(u''.join(TEX_SPECIALS)))
+
+def escape(text):
+    """ text with all TeX specials escaped, in a single pass """
+    return TEX_SPECIAL.sub(lambda m: TEX_SPECIALS[m.group()], text)
+
+class LineTotals():
+    """ Iterates over order lines as (description, price, count,
+        line total), and adds up total on the way
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.total = Decimal(0)
+
+    def __iter__(self):
+        for name, price, count, comment in self.lines:
+            price = decimal(price)
+            count = decimal(count)
+            if comment:
+                name = u"%s - %s" % (name, comment)
+            lineTotal = amount(price * count)
+            self.total += lineTotal
+            yield name, price, count, lineTotal
+
+    def vat(self):
+        return amount(self.total * VAT_SHARE)
+
+def articles(lines):
+    """ The \product-lines of a LineTotals """
+    for name, price, count, lineTotal in lines:
+        yield u"\\product{%s}{%.2f}{%.2f}{%s}\n" % (escape(unicode(name)),
+                price, count, lineTotal)
+
+class Template():
+    """ A template split once into literal text and \replacevar{name}
+        slots, so rendering is a single join.
+    """
+    PLACEHOLDER = re.compile(r'\\replacevar\{(\w+)\}')
+
+    def __init__(self, text):
+        parts = self.PLACEHOLDER.split(text)
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+
+        # Everything before \begin{document} is the same for all invoices
+        self.preamble = None
+        if BEGIN_DOCUMENT in text:
+            self.preamble = text[:text.index(BEGIN_DOCUMENT)]
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "r") as inputFile:
+            return cls(inputFile.read().decode("utf-8"))
+
+    def chunks(self, values):
+        """ Fill in the slots from values, slots without a value
+            are left as they are. A value is either text, an iterable
+            of text which is passed on as it is produced, or a function
+            returning text, which is called when its slot is reached.
+        """
+        yield self.literals[0]
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = values.get(name)
+            if value is None:
+                yield u"\\replacevar{%s}" % name
+            elif isinstance(value, basestring):
+                yield value
+            elif callable(value):
+                yield value()
+            else:
+                for chunk in value:
+                    yield chunk
+            yield literal
+
+    def render(self, values):
+        return u"".join(self.chunks(values))
+
+class LatexSource():
+    """ The LaTeX source of the invoice of one order. It is produced
+        from the database every time it is iterated over, so the source
+        of a large order is never held in memory as a whole
+    """
+    fieldNames = [ "customerName", "customerReference", "customerPostcode",
+    "customerCity", "customerAddress1", "customerAddress2" ]
+
+    def __init__(self, template, orderId, customerInfo, dateStr):
+        self.template = template
+        self.orderId = orderId
+        self.customerInfo = customerInfo
+        self.dateStr = dateStr
+
+    def __iter__(self):
+        lines = LineTotals(order_lines(self.orderId))
+        values = {
+            "articles": articles(lines),
+            # Called once all articles have been written
+            "total": lambda: unicode(lines.total),
+            "vat": lambda: unicode(lines.vat()),
+            "invoiceNumber": unicode(self.orderId),
+            "invoiceDate": self.dateStr,
+        }
+        for k,field in enumerate(self.fieldNames):
+            if self.customerInfo[k] is not None and len(self.customerInfo[k]):
+                values[field] = escape(self.customerInfo[k]) + u"\\\\"
+        return self.template.chunks(values)
+
+def build_format(preamble):
+    """ Dump the preamble into a pdflatex format with mylatexformat, so
+        invoices do not have to load all the packages again. The format is
+        kept in CACHE_DIR by a hash of the preamble and pdflatex version,
+        and only built when that changes. Returns the format to pass to
+        -fmt, or None if it could not be built.
+    """
+    try:
+        version = subprocess.check_output(['pdflatex', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    digest = hashlib.sha1(version + preamble.encode("utf-8")).hexdigest()
+    name = 'invoice-%s' % digest[:16]
+    fmt = os.path.abspath(os.path.join(CACHE_DIR, name))
+    if os.path.exists(fmt + '.fmt'):
+        return fmt
+
+    tmpdir = tempfile.mkdtemp(prefix = name + '-')
+    with open(os.path.join(tmpdir, name + '.tex'), 'w') as f:
+        f.write(preamble.encode("utf-8"))
+        f.write(BEGIN_DOCUMENT + "\n\\end{document}\n")
+    with open(os.path.join(tmpdir, 'pdflatex.out'), 'w') as out:
+        ret = subprocess.call(['pdflatex', '-ini', '-interaction=nonstopmode',
+            '-halt-on-error', '-jobname=' + name, '&pdflatex',
+            'mylatexformat.ltx', name + '.tex'],
+            cwd = tmpdir, stdout = out, stderr = subprocess.STDOUT)
+    if ret != 0 or not os.path.exists(os.path.join(tmpdir, name + '.fmt')):
+        print "Could not build format, see %s" % tmpdir
+        return None
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    tmp = '%s.%d.tmp' % (fmt, os.getpid())
+    shutil.move(os.path.join(tmpdir, name + '.fmt'), tmp)
+    os.rename(tmp, fmt + '.fmt')
+    shutil.rmtree(tmpdir)
+    return fmt
+
+def make_dirs(path):
+    """ Create a directory unless it exists, parallel jobs may race """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def run_pdflatex(jobname, source, timeout, fmt = None):
+    """ Run pdflatex in a temporary directory of its own, so that parallel
+        runs do not share aux files, and move the PDF to OUTPUT_DIR.
+        source is written to a file there chunk by chunk as it is produced,
+        pdflatex in nonstopmode does not read more than a line from stdin.
+        fmt is a format from build_format() to start from.
+        Returns None on success, otherwise why it failed.
+    """
+    tmpdir = tempfile.mkdtemp(prefix = jobname + '-')
+    texfile = os.path.join(tmpdir, jobname + '.tex')
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        p.kill()
+
+    with open(texfile, 'wb', SOURCE_BUFFER) as f:
+        for chunk in source:
+            f.write(chunk.encode("utf-8"))
+
+    args = ['pdflatex', '-interaction=nonstopmode', '-halt-on-error',
+            '-jobname', jobname, '-output-directory', tmpdir, texfile]
+    if fmt is not None:
+        # The format skips the preamble of the source
+        args.insert(1, '-fmt=' + fmt)
+
+    with open(os.devnull) as null, \
+            open(os.path.join(tmpdir, 'pdflatex.out'), 'w') as out:
+        try:
+            p = subprocess.Popen(args, stdin = null, stdout = out,
+                stderr = subprocess.STDOUT)
+        except OSError as e:
+            shutil.rmtree(tmpdir)
+            return "could not run pdflatex: %s" % e
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            p.wait()
+        finally:
+            timer.cancel()
+
+    if timed_out:
+        return "timed out after %ds, see %s" % (timeout, tmpdir)
+    if p.returncode != 0:
+        return "pdflatex exited with %d, see %s" % (p.returncode, tmpdir)
+
+    try:
+        shutil.move(os.path.join(tmpdir, jobname + '.pdf'),
+                os.path.join(OUTPUT_DIR, jobname + '.pdf'))
+    except (OSError, IOError) as e:
+        return "could not move the PDF: %s, see %s" % (e, tmpdir)
+    shutil.rmtree(tmpdir)
+    return None
+
+class LatexRenderer():
+    """ Renders invoice.tex with pdflatex """
+    name = 'latex'
+
+    def __init__(self, args):
+        self.template = Template.load("invoice.tex")
+        self.fmt = None
+        if not args.no_format and self.template.preamble is not None:
+            self.fmt = build_format(self.template.preamble)
+
+    def source(self, orderId, customerInfo, dateStr):
+        """ The input of render(). Iterating over it gives the text
+            which is the cache key
+        """
+        return LatexSource(self.template, orderId, customerInfo, dateStr)
+
+    def render(self, jobname, source, timeout, sha1 = None):
+        """ sha1 is fed the source as it is written """
+        if sha1 is not None:
+            source = hashed(source, sha1)
+        return run_pdflatex(jobname, source, timeout, self.fmt)
+
+class PdfRenderer():
+    """ Writes the PDF directly with pdfinvoice, without TeX """
+    name = 'pdf'
+    def __init__(self, args):
+        pass
+
+    def source(self, orderId, customerInfo, dateStr):
+        return PdfSource(orderId, customerInfo, dateStr)
+
+    def render(self, jobname, source, timeout, sha1 = None):
+        target = os.path.join(OUTPUT_DIR, jobname + '.pdf')
+        tmp = '%s.%d.tmp' % (target, threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as f:
+                pdfinvoice.write_invoice(f, source.invoice(sha1))
+        except (IOError, UnicodeError) as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return "could not write PDF: %s" % e
+        os.rename(tmp, target)
+        return None
+
+class PdfSource():
+    """ The invoice of one order for PdfRenderer. Iterating over it
+        gives the text of the cache key, line by line
+    """
+    CUSTOMER_FIELDS = [ "name", "reference", "postcode", "city",
+    "address1", "address2" ]
+
+    def __init__(self, orderId, customerInfo, dateStr):
+        self.orderId = orderId
+        self.customer = dict(zip(self.CUSTOMER_FIELDS, customerInfo))
+        self.dateStr = dateStr
+
+    def invoice(self, sha1 = None):
+        """ The invoice for pdfinvoice, with the lines read as the
+            PDF is written. sha1 is fed the text of the cache key of
+            what is read on the way
+        """
+        lines = LineTotals(order_lines(self.orderId))
+        return {
+            "number": unicode(self.orderId),
+            "date": self.dateStr,
+            "customer": self.customer,
+            "lines": lines if sha1 is None else self.hashed(lines, sha1),
+            "total": lambda: lines.total,
+            "vat": lines.vat,
+        }
+
+    def header(self):
+        return u"pdfinvoice\n%r\n" % ((self.orderId, self.dateStr,
+            sorted(self.customer.items())),)
+
+    def key(self, line):
+        return u"%r\n" % (line,)
+
+    def hashed(self, lines, sha1):
+        """ lines, feeding sha1 with their cache key text on the way """
+        sha1.update(self.header().encode("utf-8"))
+        for line in lines:
+            sha1.update(self.key(line).encode("utf-8"))
+            yield line
+
+    def __iter__(self):
+        yield self.header()
+        for line in LineTotals(order_lines(self.orderId)):
+            yield self.key(line)
+
+RENDERERS = dict((r.name, r) for r in (LatexRenderer, PdfRenderer))
+
+def hashed(chunks, sha1):
+    """ The chunks of a source, feeding sha1 with them on the way """
+    for chunk in chunks:
+        sha1.update(chunk.encode("utf-8"))
+        yield chunk
+
+def cache_path(sha1):
+    """ Where the PDF of a source with this digest is cached. The source
+        holds the template, customer, order lines and date, so it is
+        the cache key.
+    """
+    return os.path.join(CACHE_DIR, sha1.hexdigest() + '.pdf')
+
+def render_cached(renderer, jobname, source, timeout, use_cache = True):
+    """ Copy the PDF from the cache if this source was rendered before,
+        otherwise render it and cache the result.
+        Returns None on success, otherwise why it failed.
+    """
+    if not use_cache:
+        return renderer.render(jobname, source, timeout)
+
+    target = os.path.join(OUTPUT_DIR, jobname + '.pdf')
+    sha1 = hashlib.sha1()
+    for chunk in hashed(source, sha1):
+        pass
+    cached = cache_path(sha1)
+    if os.path.exists(cached):
+        shutil.copyfile(cached, target)
+        return None
+
+    # The order may change before it is read again for rendering,
+    # so the PDF is cached by the source it was rendered from
+    sha1 = hashlib.sha1()
+    error = renderer.render(jobname, source, timeout, sha1)
+    if error is None:
+        cached = cache_path(sha1)
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        # Copy under a temporary name first, parallel jobs
+        # must never see a half-written file
+        tmp = '%s.%d.tmp' % (cached, threading.current_thread().ident)
+        shutil.copyfile(target, tmp)
+        os.rename(tmp, cached)
+    return error
+
+def render_orders(pool, renderer, orders, dateStr, args, done = None):
+    """ Render the invoices of orders in pool, and record the invoiceFile
+        of each that succeeded. Each is committed at once, so the database
+        is not locked for iv.py while the rest are rendered.
+        done(orderId, error) is called as each invoice is finished.
+        Returns the number rendered and a list of (orderId, error)
+    """
+    def jobs():
+        for orderId, customerInfo in orders:
+            jobname = 'invoice-%s-%d' % (dateStr, orderId)
+            source = renderer.source(orderId, customerInfo, dateStr)
+            if args.echo:
+                for chunk in source:
+                    sys.stdout.write(chunk.encode("utf-8"))
+            yield orderId, jobname, source
+
+    def run(job):
+        orderId, jobname, source = job
+        try:
+            error = render_cached(renderer, jobname, source, args.timeout,
+                    not args.no_cache)
+        except Exception as e:
+            # One invoice which cannot be rendered must not stop the rest
+            error = "%s: %s" % (type(e).__name__, e)
+        return orderId, jobname, error
+
+    make_dirs(OUTPUT_DIR)
+    rendered = 0
+    failed = []
+    for orderId, jobname, error in pool.imap_unordered(run, jobs()):
+        if error is None:
+            rendered += 1
+            invoiceFile = os.path.join(OUTPUT_DIR, jobname + '.pdf')
+            db_cursor.execute("UPDATE orders SET invoiceFile = ? WHERE id = ?",
+                    (invoiceFile, orderId))
+            db_conn.commit()
+            print "Created %s" % invoiceFile
+        else:
+            failed.append((orderId, error))
+        if done is not None:
+            done(orderId, error)
+    return rendered, failed
+
+def claim_jobs(limit):
+    """ Mark up to limit queued render jobs as being rendered.
+        Returns them as a list of (jobId, orderId)
+    """
+    db_cursor.execute("""
+    SELECT id, orderId FROM render_jobs WHERE status = ?
+    ORDER BY id LIMIT ?""", (iv.RENDER_QUEUED, limit))
+    claimed = []
+    for jobId, orderId in db_cursor.fetchall():
+        # Another daemon may have claimed it since
+        db_cursor.execute("UPDATE render_jobs SET status = ? "
+                "WHERE id = ? AND status = ?",
+                (iv.RENDER_RUNNING, jobId, iv.RENDER_QUEUED))
+        if db_cursor.rowcount == 1:
+            claimed.append((jobId, orderId))
+    db_conn.commit()
+    return claimed
+
+def lock_daemon():
+    """ Take the lock of the daemon of this database. Returns the locked
+        file, which has to stay open, or None if another daemon has it
+    """
+    f = open(DAEMON_LOCK % iv.db_pool.filename, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        f.close()
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return None
+    return f
+
+def daemon(pool, renderer, args):
+    """ Render the invoices queued in render_jobs by iv.py, until killed """
+    lock = lock_daemon()
+    if lock is None:
+        print "Another daemon is rendering the invoices of %s" % \
+                iv.db_pool.filename
+        return 1
+
+    # Creates render_jobs if iv.py has not been run since it was added
+    iv.IvDB()
+
+    # Jobs of a daemon which died while rendering are taken up again.
+    # No other daemon can be running, it would hold the lock
+    db_cursor.execute("UPDATE render_jobs SET status = ? WHERE status = ?",
+            (iv.RENDER_QUEUED, iv.RENDER_RUNNING))
+    db_conn.commit()
+
+    while True:
+        claimed = claim_jobs(args.jobs * 4)
+        if not claimed:
+            time.sleep(args.poll)
+            continue
+
+        # Job ids by order, each is finished as soon as its invoice is
+        jobIds = {}
+        for jobId, orderId in claimed:
+            jobIds.setdefault(orderId, []).append(jobId)
+
+        def finish(orderId, error):
+            if error is not None:
+                print "Order %d failed: %s" % (orderId, error)
+            for jobId in jobIds.pop(orderId, ()):
+                db_cursor.execute("UPDATE render_jobs SET status = ?, "
+                        "error = ? WHERE id = ?", (iv.RENDER_DONE
+                            if error is None else iv.RENDER_FAILED,
+                            error, jobId))
+            db_conn.commit()
+            sys.stdout.flush()
+
+        error = "no such order"
+        try:
+            orderIds = sorted(jobIds)
+            orders = load_orders("o.id IN (%s)" %
+                    ",".join("?" * len(orderIds)), orderIds)
+            dateStr = datetime.now().strftime('%Y-%m-%d')
+            render_orders(pool, renderer, orders, dateStr, args, finish)
+        except Exception as e:
+            # Failing the jobs keeps them from being taken up again
+            db_conn.rollback()
+            error = "%s: %s" % (type(e).__name__, e)
+        for orderId in list(jobIds):
+            finish(orderId, error)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate invoices as PDF")
+    parser.add_argument('orderid', nargs = '?', type = int,
+            help = "invoice a single order")
+    parser.add_argument('--status', type = int,
+            help = "invoice all orders with this status")
+    parser.add_argument('--ids',
+            help = "invoice orders by id, e.g. 10-500 or 3,7,10-20")
+    parser.add_argument('--all-unsent', action = 'store_true',
+            help = "invoice all orders which have not been sent")
+    parser.add_argument('-j', '--jobs', type = int,
+            default = multiprocessing.cpu_count(),
+            help = "number of invoices rendered at once (default: %(default)s)")
+    parser.add_argument('--no-cache', action = 'store_true',
+            help = "always run pdflatex, even for unchanged invoices")
+    parser.add_argument('--no-format', action = 'store_true',
+            help = "do not precompile the preamble of invoice.tex")
+    parser.add_argument('--backend', choices = sorted(RENDERERS),
+            default = 'latex',
+            help = "render with pdflatex, or write the PDF directly "
+            "(default: %(default)s)")
+    parser.add_argument('--echo', action = 'store_true',
+            help = "print the source of each invoice")
+    parser.add_argument('--timeout', type = int, default = 120,
+            help = "seconds before a pdflatex run is killed "
+            "(default: %(default)s)")
+    parser.add_argument('--daemon', action = 'store_true',
+            help = "keep rendering the invoices queued by iv.py")
+    parser.add_argument('--poll', type = float, default = 2,
+            help = "seconds between looking for queued invoices "
+            "(default: %(default)s)")
+    args = parser.parse_args()
+
+    where, params = order_filter(args)
+    if not where and not args.daemon:
+        parser.print_usage()
+        return 1
+
+    renderer = RENDERERS[args.backend](args)
+    pool = ThreadPool(max(args.jobs, 1))
+    if args.daemon:
+        try:
+            return daemon(pool, renderer, args)
+        except KeyboardInterrupt:
+            return 0
+
+    date = datetime.now()
+    dateStr = date.strftime('%Y-%m-%d')
+
+    orders = load_orders(where, params)
+
+    rendered, failed = render_orders(pool, renderer, orders, dateStr, args)
+    pool.close()
+    pool.join()
+
+    print "Rendered %d of %d invoices" % (rendered, rendered + len(failed))
+    for orderId, error in sorted(failed):
+        print "Order %d failed: %s" % (orderId, error)
+    return 1 if failed else 0
 
-db_cursor.execute("""
-SELECT name, reference, postcode, city, address1, address2
-FROM orders o
-LEFT JOIN customer c ON c.id = o.customerId
-WHERE o.id = %d""" % orderId)
-customerInfo = db_cursor.fetchone()
-
-db_cursor.execute("""
-SELECT p.name, op.price, op.count, op.comment FROM order_products op
-LEFT JOIN products p ON p.id = op.productId
-WHERE orderId = %d""" % orderId)
-productsStr = u""
-for p in db_cursor.fetchall():
-    price = p[1] if p[1] is not None else 0
-    count = p[2] if p[2] is not None else 0
-
-    if len(p[3]):
-        productsStr = productsStr + u"\\product{%s - %s}{%.2f}{%.2f}\n" % (p[0], p[3], price, count)
-    else:
-        productsStr = productsStr + u"\\product{%s}{%.2f}{%.2f}\n" % (p[0], price, count)
-
-productsStr = productsStr.replace('&',"\\&")
-productsStr = productsStr.replace('"',"$\\,''$")
-
-p = subprocess.Popen(['pdflatex', '-jobname', 'invoice-%s-%d' % (dateStr,orderId),
-    '-output-directory','output'], stdin = subprocess.PIPE, stdout = None)
-
-with open("invoice.tex","r") as inputFile:
-    for line in inputFile:
-        line = line.decode("utf-8")
-        fieldNames = [ "customerName", "customerReference", "customerPostcode",
-        "customerCity", "customerAddress1", "customerAddress2" ]
-        for k,field in enumerate(fieldNames):
-            if customerInfo[k] is not None and len(customerInfo[k]):
-                line = line.replace(u"\\replacevar{%s}" % field, customerInfo[k] + u"\\\\")
-        line = line.replace(u"\\replacevar{articles}", productsStr)
-        line = line.replace(u"\\replacevar{invoiceNumber}", str(orderId))
-        line = line.replace(u"\\replacevar{invoiceDate}", dateStr)
-
-        p.stdin.write(line.encode("utf-8"))
-        print line.encode("utf-8"),
-
-print "Waiting for pdflatex to finish..."
-p.wait()
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,149 @@
 #!/usr/bin/env python
 # encoding: utf-8
 import npyscreen
+import curses
+import curses.ascii
 import sqlite3
+import collections
+import io
 import os
+import threading
+import weakref
 from decimal import Decimal, DecimalException
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
 
+CONFIG_FILENAME = 'invoice.conf'
 DB_FILENAME = 'invoice.db'
 
+# Maximum number of connections handed out at once (one per thread),
+# and number of prepared statements each connection keeps cached
+DB_POOL_SIZE = 4
+DB_CACHED_STATEMENTS = 256
+
+# Pragmas applied to every new connection. The profile is selected with
+# 'profile' in the [database] section of the config file, and single
+# pragmas can be overridden in its [pragmas] section.
+# WAL needs shared memory, so keep 'default' for databases on network shares
+PRAGMA_PROFILES = {
+    'default': [],
+    'wal': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', '-16000'),       # 16 MB
+        ('mmap_size', '268435456'),     # 256 MB
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
 # Setup our decimal-helper
 sqlite3.register_converter("DECIMAL", Decimal)
 sqlite3.register_adapter(Decimal, str)
 
+class ConnectionPool():
+    """ Process-wide pool of long-lived SQLite3 connections.
+
+        A thread holds at most one connection at a time, and nested
+        SQLite3DB-blocks within the same thread share it. No more than
+        'size' connections are checked out at once, further threads
+        wait until one is returned.
+    """
+    def __init__(self, filename, pragmas = (), size = DB_POOL_SIZE):
+        self.filename = filename
+        self.pragmas = pragmas
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.local = threading.local()
+
+    def connect(self):
+        conn = sqlite3.connect(self.filename,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=DB_CACHED_STATEMENTS,
+                check_same_thread=False)
+        for name, value in self.pragmas:
+            conn.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+        return conn
+
+    def acquire(self):
+        depth = getattr(self.local, 'depth', 0)
+        if depth == 0:
+            self.slots.acquire()
+            try:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    conn = self.connect()
+            except:
+                self.slots.release()
+                raise
+            self.local.conn = conn
+        self.local.depth = depth + 1
+        return self.local.conn
+
+    def release(self):
+        """ Returns True when the outermost block of this thread let go """
+        self.local.depth -= 1
+        if self.local.depth:
+            return False
+
+        conn = self.local.conn
+        self.local.conn = None
+        # Anything not committed is thrown away, just as when
+        # the connection used to be closed after every block
+        conn.rollback()
+        with self.lock:
+            self.idle.append(conn)
+        self.slots.release()
+        return True
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+def load_config(filename = CONFIG_FILENAME):
+    """ Read the config file, missing settings get their defaults """
+    config = RawConfigParser()
+    config.optionxform = str
+    config.add_section('database')
+    config.set('database', 'filename', DB_FILENAME)
+    config.set('database', 'profile', 'default')
+    config.add_section('pragmas')
+    config.read(filename)
+    return config
+
+def pragma_profile(config):
+    """ Pragmas of the configured profile, with overrides applied """
+    profile = config.get('database', 'profile')
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError("Unknown pragma profile %s" % profile)
+
+    overrides = dict(config.items('pragmas'))
+    pragmas = [(name, overrides.pop(name, value))
+            for name, value in PRAGMA_PROFILES[profile]]
+    return pragmas + sorted(overrides.items())
+
+config = load_config()
+db_pool = ConnectionPool(config.get('database', 'filename'),
+        pragma_profile(config))
+
 class SQLite3DB():
-    """ Wrapper for SQLite3 database and cursor objects,
-        which sets up adapters and converters,
-        and closes the database
+    """ Wrapper for SQLite3 database and cursor objects.
+        The connection is borrowed from the connection pool,
+        and every block gets a cursor of its own
     """
     def __enter__(self):
-        self.db = sqlite3.connect(DB_FILENAME, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.db = db_pool.acquire()
         self.c = self.db.cursor()
         return self
 
     def __exit__(self, type, value, traceback):
         self.c.close()
-        self.db.close()
+        db_pool.release()
 
     def execute(self, *args, **kwargs):
         return self.c.execute(*args,**kwargs)
@@ -31,242 +151,824 @@ class SQLite3DB():
     def commit(self, *args, **kwargs):
         return self.db.commit(*args,**kwargs)
 
-class SubRow(sqlite3.Row):
-    def __init__(self, *args, **kwargs):
-        if len(args):
-            super(SubRow, self).__init__(*args,**kwargs)
+class IdentityMap():
+    """ Keeps a single object per row, keyed by (table, id).
 
-            for k in self.keys():
-                setattr(self,k.lower(),self[k])
+        Objects are held weakly, so rows nobody uses any longer are
+        dropped. Objects with unsaved changes are handed to keep(),
+        which holds on to them until they are saved or forgotten.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = weakref.WeakValueDictionary()
+        self.kept = {}
+
+    def get(self, cls, id):
+        return self.objects.get((cls.table, id))
+
+    def add(self, obj, names = None):
+        """ Register a freshly loaded object, returns the one to use.
+            If the row is already known, that object is refreshed with
+            the values of 'names' instead, unless it has been kept or
+            has unsaved changes, which would be lost.
+        """
+        key = (obj.table, obj.id)
+        with self.lock:
+            known = self.objects.get(key)
+            if known is None:
+                self.objects[key] = obj
+                return obj
+            if key not in self.kept and not known._dirty:
+                names = names or known.fields
+                for k in names:
+                    object.__setattr__(known, k, getattr(obj, k))
+                # What was just loaded is no longer a change
+                known._dirty.difference_update(names)
+            return known
+
+    def keep(self, obj):
+        with self.lock:
+            self.kept[(obj.table, obj.id)] = obj
+            self.objects[(obj.table, obj.id)] = obj
+
+    def saved(self, objs):
+        with self.lock:
+            for obj in objs:
+                self.kept.pop((obj.table, obj.id), None)
+                self.objects[(obj.table, obj.id)] = obj
+
+    def forget(self, objs):
+        with self.lock:
+            for obj in objs:
+                key = (obj.table, obj.id)
+                self.kept.pop(key, None)
+                if self.objects.get(key) is obj:
+                    del self.objects[key]
+
+identity_map = IdentityMap()
+
+# Compares unequal to every value
+_UNSET = object()
+
+class ConflictError(Exception):
+    """ Rows were changed or deleted by someone else since they were loaded """
+    def __init__(self, table, ids):
+        Exception.__init__(self, "Rows %s of %s were changed meanwhile" %
+                (', '.join(str(id) for id in ids), table))
+        self.table = table
+        self.ids = ids
+
+# Attributes which saving changes in memory. They are put back by
+# restore() when the transaction is rolled back, so nothing looks saved
+SAVED_STATE = ('id', 'version', 'saved_count')
+
+def snapshot(objs):
+    """ State of objects before they are saved or deleted """
+    return [(obj, set(obj._dirty), [(k, getattr(obj, k))
+            for k in SAVED_STATE if k in obj.__slots__]) for obj in objs]
+
+def restore(state):
+    """ Put objects back as they were when snapshot() was taken """
+    for obj, dirty, values in state:
+        values = dict(values)
+        moved = obj.id != values['id']
+        if moved:
+            # Inserted or deleted meanwhile
+            identity_map.forget([obj])
+        for k, value in values.items():
+            object.__setattr__(obj, k, value)
+        obj._dirty.clear()
+        obj._dirty.update(dirty)
+        if moved and obj.id != -1:
+            identity_map.saved([obj])
+
+class Persistent(object):
+    """ Base for objects stored in a table, keyed by 'id'.
+
+        'columns' lists the attributes written on insert, and
+        'update_columns' the ones written on update (defaults to 'columns').
+        Updates only write the columns in the row's _dirty set.
+        The class methods work on lists of rows within an open SQLite3DB,
+        so that single saves and Session flushes share the same statements.
+
+        Tables which are 'versioned' have a version column, which every
+        update increments. An update of a row whose version is not the
+        one it was loaded with raises ConflictError.
+    """
+    __slots__ = ()
+    table = None
+    columns = ()
+    update_columns = None
+    versioned = False
+
+    @classmethod
+    def _insert(cls, db, rows):
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (cls.table,
+                ', '.join(cls.columns), ', '.join('?' * len(cls.columns)))
+        db.c.executemany(sql,
+                ([getattr(r, k) for k in cls.columns] for r in rows))
+
+        # The table stays locked for writing until we commit, and sqlite
+        # hands out max(id) + 1 to each new row, so the ids are consecutive
+        last = db.db.execute("SELECT last_insert_rowid()").fetchone()[0]
+        for r, id in zip(rows, range(last - len(rows) + 1, last + 1)):
+            r.id = id
+
+    @classmethod
+    def _update(cls, db, rows):
+        """ Rows with the same changed columns are written by one statement,
+            rows without changes are left alone
+        """
+        columns = cls.update_columns or cls.columns
+        groups = collections.OrderedDict()
+        for r in rows:
+            changed = tuple(k for k in columns if k in r._dirty)
+            if changed:
+                groups.setdefault(changed, []).append(r)
+        for changed, group in groups.items():
+            cls._update_columns(db, changed, group)
+        if cls.versioned:
+            for group in groups.values():
+                for r in group:
+                    r.version += 1
+
+    @classmethod
+    def _update_columns(cls, db, columns, rows):
+        if not cls.versioned:
+            sql = "UPDATE %s SET %s WHERE id = ?" % (cls.table,
+                    ', '.join('%s = ?' % k for k in columns))
+            db.c.executemany(sql,
+                    ([getattr(r, k) for k in columns] + [r.id] for r in rows))
+            return
 
-    def save(self):
-        pass
+        sql = "UPDATE %s SET %s, version = version + 1 " \
+                "WHERE id = ? AND version = ?" % (cls.table,
+                ', '.join('%s = ?' % k for k in columns))
+        db.c.executemany(sql, ([getattr(r, k) for k in columns] +
+                [r.id, r.version] for r in rows))
+        if db.c.rowcount != len(rows):
+            # Nothing of the transaction can be kept, and without our
+            # updates the rows which changed meanwhile can be told apart
+            db.db.rollback()
+            raise ConflictError(cls.table, cls._conflicts(db, rows))
+
+    @classmethod
+    def _conflicts(cls, db, rows):
+        """ Ids of rows whose version is not the one they were loaded with """
+        versions = dict(db.db.execute(
+                "SELECT id, version FROM %s WHERE id IN (%s)" % (cls.table,
+                    ', '.join('?' * len(rows))), [r.id for r in rows]))
+        return [r.id for r in rows if versions.get(r.id) != r.version]
+
+    @classmethod
+    def _delete(cls, db, rows):
+        db.c.executemany("DELETE FROM %s WHERE id = ?" % cls.table,
+                ((r.id,) for r in rows))
+        identity_map.forget(rows)
+        for r in rows:
+            r.id = -1
+
+    @classmethod
+    def _save(cls, db, rows):
+        new = [r for r in rows if r.id == -1]
+        old = [r for r in rows if r.id != -1]
+        # Updates first, a conflict then raises before any row is inserted
+        if old:
+            cls._update(db, old)
+        if new:
+            cls._insert(db, new)
+        for r in rows:
+            r._dirty.clear()
+        identity_map.saved(rows)
+
+    @classmethod
+    def save_many(cls, rows):
+        """ Insert new rows and update the changed columns of existing
+            ones, with one statement per set of changed columns.
+            New rows get their ids filled in.
+        """
+        state = snapshot(rows)
+        try:
+            with SQLite3DB() as db:
+                cls._save(db, rows)
+                db.commit()
+        except:
+            restore(state)
+            raise
 
-class Distributor(SubRow):
-    pass
+    @classmethod
+    def delete_many(cls, rows):
+        rows = [r for r in rows if r.id != -1]
+        if not rows:
+            return
 
-class Product(SubRow):
-    id = -1
-    name = ''
-    description = ''
-    price = 0.0
-    stock = 0
-    distributor = 0
-    distributor_price = 0
-    upc = ''
-    physical_product = 1
+        state = snapshot(rows)
+        try:
+            with SQLite3DB() as db:
+                cls._delete(db, rows)
+                db.commit()
+        except:
+            restore(state)
+            raise
 
     def save(self):
-        with SQLite3DB() as db:
-            if self.id == -1:
-                db.execute("""
-                    INSERT INTO products (name, price, stock, description,
-                        distributor, distributor_price, UPC, physical_product)
-                        VALUES (?,?,?,?,?,?,?,?)""",
-                        (self.name, self.price, self.stock, self.description,
-                            self.distributor, self.distributor_price, self.upc,
-                            self.physical_product,))
-                self.id = db.c.lastrowid
-            else:
-                db.execute("""
-                    UPDATE products SET
-                        name = ?, price = ?, stock = ?, description = ?,
-                        distributor = ?, distributor_price = ?,
-                        UPC = ?, physical_product = ?
-                        WHERE id = ?""",
-                        (self.name, self.price, self.stock, self.description,
-                            self.distributor, self.distributor_price, self.upc,
-                            self.physical_product,self.id,))
-            db.commit()
+        self.save_many([self])
         return self.id
-    pass
 
-class Customer(SubRow):
-    id = -1
-    name = ''
-    reference = ''
-    address1 = ''
-    address2 = ''
-    postcode = ''
-    city = ''
+    def delete(self):
+        self.delete_many([self])
 
-    def save(self):
-        with SQLite3DB() as db:
-            if self.id == -1:
-                db.execute("""
-                    INSERT INTO customer
-                    (name, reference, address1, address2, postcode, city)
-                    VALUES (?, ?, ?, ?, ?, ?) """,
-                    (self.name, self.reference, self.address1, self.address2,
-                        self.postcode, self.city,))
-                self.id = db.c.lastrowid
-            else:
-                db.execute("""
-                    UPDATE customer SET
-                    name = ?,
-                    reference = ?,
-                    address1 = ?,
-                    address2 = ?,
-                    postcode = ?,
-                    city = ?
-                    WHERE  id = ?""",
-                    (self.name, self.reference, self.address1, self.address2,
-                        self.postcode, self.city, self.id,))
-            db.commit()
-
-class OrderProduct():
-    id = -1
-    orderid = 0
-    productid = 0
-    price = 0
-    count = 0
-    comment = ''
+class Model(Persistent):
+    """ Row of a table, with one slot per attribute.
 
+        'fields' are the columns of the table in table order. A model can be
+        indexed and unpacked through them like the row tuple it came from.
+        Attributes are the lower-cased column names, and start out with the
+        values in 'defaults'. Loaded rows go through the identity map, so
+        every row is represented by one object only.
+
+        Attributes set to a different value are recorded in _dirty until
+        the object is saved. Loading bypasses this with object.__setattr__.
+    """
+    __slots__ = ('__weakref__', '_dirty')
+    fields = ()
+    defaults = {}
+
+    # Cursor description last seen by factory(), with its attribute
+    # names and the attributes it leaves at their defaults
+    _description = (None, (), ())
+
+    def __init__(self, **kwargs):
+        object.__setattr__(self, '_dirty', set())
+        for k in self.__slots__:
+            object.__setattr__(self, k, kwargs.get(k, self.defaults.get(k)))
+
+    def __setattr__(self, name, value):
+        if getattr(self, name, _UNSET) != value:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    @classmethod
+    def factory(cls, cursor, row):
+        """ Row factory for cursors selecting (some of) the columns """
+        description, names, missing = cls._description
+        if cursor.description is not description:
+            names = [d[0].lower() for d in cursor.description]
+            missing = [k for k in cls.__slots__ if k not in names]
+            cls._description = (cursor.description, names, missing)
+
+        obj = cls.__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(obj, '_dirty', set())
+        for k in missing:
+            setattr_(obj, k, cls.defaults.get(k))
+        for k, value in zip(names, row):
+            setattr_(obj, k, value)
+        return identity_map.add(obj, names)
+
+    @classmethod
+    def get(cls, id):
+        """ Object of the row with this id, only loaded if not known yet """
+        obj = identity_map.get(cls, id)
+        if obj is None:
+            sql, params = select_sql(cls, [('id', '=', id)])
+            with SQLite3DB() as db:
+                db.c.row_factory = cls.factory
+                obj = db.c.execute(sql, params).fetchone()
+        return obj
+
+    def __getitem__(self, idx):
+        return getattr(self, self.fields[idx])
+
+    def __iter__(self):
+        for k in self.fields:
+            yield getattr(self, k)
+
+    def __len__(self):
+        return len(self.fields)
+
+class Distributor(Model):
+    table = 'distributor'
+    fields = ('id', 'name')
+    columns = ('name',)
+    __slots__ = fields
+    defaults = {'id': -1, 'name': ''}
+
+class Product(Model):
+    table = 'products'
+    fields = ('id', 'name', 'description', 'physical_product',
+            'distributor_price', 'price', 'stock', 'distributor', 'upc',
+            'version')
+    columns = ('name', 'price', 'stock', 'description', 'distributor',
+            'distributor_price', 'upc', 'physical_product')
+    # Stock is only changed through StockMovement
+    update_columns = ('name', 'price', 'description', 'distributor',
+            'distributor_price', 'upc', 'physical_product')
+    versioned = True
+    __slots__ = fields
+    defaults = {
+        'id': -1,
+        'name': '',
+        'description': '',
+        'price': 0.0,
+        'stock': 0,
+        'distributor': 0,
+        'distributor_price': 0,
+        'upc': '',
+        'physical_product': 1,
+        'version': 0,
+    }
+
+    @classmethod
+    def _insert(cls, db, rows):
+        # New products start out empty, their stock is added by an
+        # opening movement like every other change
+        stock = [r.stock for r in rows]
+        try:
+            for r in rows:
+                object.__setattr__(r, 'stock', 0)
+            super(Product, cls)._insert(db, rows)
+            StockMovement._save(db, [StockMovement(productid = r.id,
+                    delta = n) for r, n in zip(rows, stock) if n])
+        finally:
+            for r, n in zip(rows, stock):
+                object.__setattr__(r, 'stock', n)
+
+class Customer(Model):
+    table = 'customer'
+    fields = ('id', 'name', 'reference', 'postcode', 'city', 'address1',
+            'address2', 'version')
+    columns = ('name', 'reference', 'address1', 'address2', 'postcode',
+            'city')
+    versioned = True
+    __slots__ = fields
+    defaults = {
+        'id': -1,
+        'name': '',
+        'reference': '',
+        'address1': '',
+        'address2': '',
+        'postcode': '',
+        'city': '',
+        'version': 0,
+    }
+
+class StockMovement(Model):
+    """ A change in the stock of a product. Recording it changes
+        products.stock in the same transaction, by the database, so
+        concurrent changes add up instead of overwriting each other
+    """
+    table = 'stock_movements'
+    fields = ('id', 'productid', 'orderproductid', 'delta', 'created')
+    columns = ('productid', 'orderproductid', 'delta')
+    __slots__ = fields
+    defaults = {
+        'id': -1,
+        'productid': 0,
+        'orderproductid': None,
+        'delta': 0,
+        'created': None,
+    }
+
+    @classmethod
+    def _insert(cls, db, rows):
+        super(StockMovement, cls)._insert(db, rows)
+        db.c.executemany("UPDATE products SET stock = stock + ? WHERE id = ?",
+                ((r.delta, r.productid) for r in rows))
+
+    @classmethod
+    def record(cls, db, lines):
+        """ Record the stock changes of (order line, delta) """
+        movements = [cls(productid = line.productid,
+                    orderproductid = line.id, delta = delta)
+                for line, delta in lines if delta and line.physical_product]
+        if movements:
+            cls._save(db, movements)
+
+class OrderProduct(Model):
+    table = 'order_products'
+    fields = ('id', 'price', 'orderid', 'productid', 'comment', 'count')
+    columns = ('orderid', 'productid', 'comment', 'price', 'count')
+    update_columns = ('comment', 'price', 'count')
     # From Product
-    name = ''
-    description = ''
-    price = 0.0
-    stock = 0
-    distributor = 0
-    distributor_price = 0
-    upc = ''
-    physical_product = 1
+    product_fields = ('name', 'description', 'stock', 'distributor',
+            'distributor_price', 'upc', 'physical_product')
+    # The count as last saved, the stock is moved by the difference
+    __slots__ = fields + product_fields + ('saved_count',)
+    defaults = {
+        'id': -1,
+        'orderid': 0,
+        'productid': 0,
+        'price': 0.0,
+        'count': 0,
+        'comment': '',
+        'name': '',
+        'description': '',
+        'stock': 0,
+        'distributor': 0,
+        'distributor_price': 0,
+        'upc': '',
+        'physical_product': 1,
+        'saved_count': 0,
+    }
 
     def __init__(self, orderid = None, product = None):
         """ Initialize from a product """
+        super(OrderProduct, self).__init__()
         self.count = 1
         if orderid:
             self.orderid = orderid
         if product is not None:
             self.productid = product.id
-            self.name = product.name
-            self.description = product.description
             self.price = product.price
-            self.stock = product.stock
-            self.distributor = product.distributor
-            self.distributor_price = product.distributor_price
-            self.upc = product.upc
-            self.physical_product = product.physical_product
-
-    def save(self):
-        with SQLite3DB() as db:
-            if self.id == -1:
-                db.execute("""
-                        INSERT INTO order_products
-                        (orderId, productId, comment, price, count)
-                        VALUES (?, ?, ?, ?,?)
-                        """, (self.orderid, self.productid, self.comment,
-                            self.price, self.count,))
-                self.id = db.c.lastrowid
-            else:
-                db.execute("""
-                        UPDATE order_products
-                        SET comment = ?, price = ?, count = ?
-                        WHERE id = ?
-                        """, (self.comment, self.price, self.count, self.id))
-            db.commit()
-
-    def delete(self):
-        if self.id == -1:
-            return
-
-        with SQLite3DB() as db:
-            db.execute("DELETE FROM order_products WHERE id = ?", (self.id,))
-            db.commit()
-        self.id = -1
-
-def OrderProductFactory(cursor, row):
-    r = OrderProduct()
-    for idx, col in enumerate(cursor.description):
-        r.__dict__[col[0].lower()] = row[idx]
-    return r
-
-
-class Order(SubRow):
-    id = -1
-    description = ''
-    customerid = 0
-    status = 0
-    invoicefile = ''
-    created = 0
+            for k in self.product_fields:
+                setattr(self, k, getattr(product, k))
+
+    @classmethod
+    def _save(cls, db, rows):
+        super(OrderProduct, cls)._save(db, rows)
+        StockMovement.record(db, [(r, r.saved_count - r.count) for r in rows])
+        for r in rows:
+            # Bookkeeping, not a change to save
+            object.__setattr__(r, 'saved_count', r.count)
+
+    @classmethod
+    def _delete(cls, db, rows):
+        # The stock of deleted lines is returned
+        StockMovement.record(db, [(r, r.saved_count) for r in rows])
+        super(OrderProduct, cls)._delete(db, rows)
+
+class Order(Model):
+    table = 'orders'
+    fields = ('id', 'description', 'customerid', 'status', 'invoicefile',
+            'created', 'version')
+    columns = ('description', 'customerid', 'status', 'invoicefile',
+            'created')
+    # invoiceFile is written by gen-pdf.py
+    update_columns = ('description', 'customerid', 'status', 'created')
+    versioned = True
+    __slots__ = fields
+    defaults = {
+        'id': -1,
+        'description': '',
+        'customerid': 0,
+        'status': 0,
+        'invoicefile': '',
+        'created': 0,
+        'version': 0,
+    }
 
     def listProducts(self):
         products = []
         with SQLite3DB() as db:
-            db.c.row_factory = OrderProductFactory
+            db.c.row_factory = OrderProduct.factory
             db.c.execute("""
                         SELECT op.id, op.orderId, op.productId, op.price, op.count,
-                        op.comment,
+                        op.count AS saved_count, op.comment,
                         p.name, p.description, p.distributor, p.distributor_price,
                         p.upc, p.physical_product
-                        distributor, distributor_price, UPC, physical_product
                         FROM order_products op
                         INNER JOIN products p ON p.id = op.productId
                         WHERE op.orderId = ?""", (self.id,))
             products = db.c.fetchall()
         return products
 
+# orders.status
+ORDER_SENT = 1
+
+# render_jobs.status
+RENDER_QUEUED = 0
+RENDER_RUNNING = 1
+RENDER_DONE = 2
+RENDER_FAILED = 3
+
+class RenderJob(Model):
+    """ An invoice for gen-pdf.py --daemon to render """
+    table = 'render_jobs'
+    fields = ('id', 'orderid', 'status', 'error', 'created')
+    columns = ('orderid', 'status')
+    __slots__ = fields
+    defaults = {
+        'id': -1,
+        'orderid': -1,
+        'status': RENDER_QUEUED,
+        'error': None,
+        'created': None,
+    }
+
+class Session():
+    """ Unit of work for saving several objects in one transaction.
+
+        Objects given to add() and delete() are collected, and written by
+        flush() grouped per class, with executemany for updates and deletes.
+        Leaving the with-block flushes what is left and commits, or rolls
+        everything back if an exception was raised. The objects are then
+        restored to what they were before their first flush:
+
+            with Session() as session:
+                session.add(order)
+                session.flush()             # order.id is now known
+                ...
+    """
+    def __init__(self):
+        self.saved = []
+        self.deleted = []
+        self.state = []
+        self.flushed = set()
 
-    def save(self):
-        with SQLite3DB() as db:
-            if self.id == -1:
-                db.c.execute("""
-                    INSERT INTO orders
-                    (description, customerId, status, invoiceFile, created)
-                    VALUES (?, ?, ?, ?, ?) """,
-                    (self.description, self.customerid, self.status,
-                        self.invoicefile, self.created))
-                self.id = db.c.lastrowid
+    def __enter__(self):
+        self.sqlite = SQLite3DB()
+        self.db = self.sqlite.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.flush()
+                self.db.commit()
             else:
-                db.c.execute("""
-                    UPDATE orders SET
-                    description = ?,
-                    customerId = ?,
-                    status = ?,
-                    invoiceFile = ?,
-                    created = ?
-                    WHERE  id = ?""",
-                    (self.description, self.customerid, self.status,
-                        self.invoicefile, self.created, self.id))
-
-            db.db.commit()
+                restore(self.state)
+        except:
+            restore(self.state)
+            raise
+        finally:
+            self.sqlite.__exit__(type, value, traceback)
+
+    def add(self, obj):
+        if not any(o is obj for o in self.saved):
+            self.saved.append(obj)
+
+    def delete(self, obj):
+        self.saved = [o for o in self.saved if o is not obj]
+        if obj.id != -1 and not any(o is obj for o in self.deleted):
+            self.deleted.append(obj)
+
+    def groups(self, objs):
+        """ Group objects per class, keeping the order classes were added in """
+        classes = []
+        groups = {}
+        for obj in objs:
+            cls = type(obj)
+            if cls not in groups:
+                classes.append(cls)
+                groups[cls] = []
+            groups[cls].append(obj)
+        return [(cls, groups[cls]) for cls in classes]
+
+    def flush(self):
+        deleted, self.deleted = self.deleted, []
+        saved, self.saved = self.saved, []
+
+        first = [obj for obj in deleted + saved if id(obj) not in self.flushed]
+        self.state.extend(snapshot(first))
+        self.flushed.update(id(obj) for obj in first)
+
+        for cls, objs in self.groups(deleted):
+            cls._delete(self.db, objs)
+
+        for cls, objs in self.groups(saved):
+            cls._save(self.db, objs)
+
+# Schema migrations, in the order they are applied. PRAGMA user_version
+# holds the number of migrations a database has been upgraded with
+MIGRATIONS = [
+    'sql/schema.sql',
+    'sql/002-indexes.sql',
+    'sql/003-render-jobs.sql',
+    'sql/004-stock-movements.sql',
+    'sql/005-row-versions.sql',
+]
+
+def sql_statements(filename):
+    """ Split an SQL script into single statements """
+    statement = u''
+    with io.open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            statement += line
+            if sqlite3.complete_statement(statement):
+                yield statement
+                statement = u''
+    if statement.strip():
+        yield statement
+
+QUERY_OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'LIKE', 'IN')
+
+def select_sql(cls, where = (), order_by = (), limit = None, offset = None,
+        after = None, columns = '*'):
+    """ Build a SELECT for cls.table, returns (sql, parameters).
+
+        after is the (value, id) of a row to continue after, for keyset
+        pagination on an order_by of (field, 'id').
+    """
+    fields = cls.fields
+
+    def field(name):
+        if name not in fields:
+            raise ValueError("Unknown field %s for %s" % (name, cls.table))
+        return name
+
+    clauses = []
+    params = []
+    for name, op, value in where:
+        op = op.upper()
+        if op not in QUERY_OPERATORS:
+            raise ValueError("Unknown operator %s" % op)
+
+        if op == 'IN':
+            value = list(value)
+            clauses.append("%s IN (%s)" % (field(name),
+                ', '.join('?' * len(value))))
+            params.extend(value)
+        elif value is None:
+            if op not in ('=', '!='):
+                raise ValueError("Cannot compare NULL with %s" % op)
+            clauses.append("%s IS %sNULL" % (field(name),
+                'NOT ' if op == '!=' else ''))
+        else:
+            clauses.append("%s %s ?" % (field(name), op))
+            params.append(value)
+
+    if after is not None:
+        name = field(order_by[0])
+        value, id = after
+        # NULLs sort first. The >= lets sqlite seek in the index
+        if value is None:
+            clauses.append("(%s IS NOT NULL OR id > ?)" % name)
+            params.append(id)
+        else:
+            clauses.append("%s >= ? AND (%s > ? OR id > ?)" % (name, name))
+            params.extend([value, value, id])
+
+    sql = "SELECT %s FROM %s" % (columns, cls.table)
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+
+    if order_by:
+        sql += " ORDER BY " + ", ".join(
+                field(k[1:]) + " DESC" if k.startswith('-') else field(k)
+                for k in order_by)
+
+    if limit is not None or offset is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, offset or 0])
+
+    return sql, params
+
+# Rows per page and number of pages kept in memory by a ResultSet
+PAGE_SIZE = 200
+PAGE_WINDOW = 8
+
+class ResultSet(object):
+    """ Read-only sequence over the rows of a query, for use as the values
+        of a MultiLine. Rows are ordered by (key, id) and fetched a page
+        at a time by keyset as they are indexed. Only the PAGE_WINDOW most
+        recently used pages are kept.
+    """
+    def __init__(self, cls, where = (), key = 'name'):
+        self.cls = cls
+        self.where = list(where)
+        self.order_by = (key, 'id')
+        self.length = None
+        self.pages = collections.OrderedDict()
+        # Page number -> (key, id) of the last row of the page before it
+        self.after = {0: None}
+
+    def __len__(self):
+        if self.length is None:
+            sql, params = select_sql(self.cls, self.where,
+                    columns = 'COUNT(*)')
+            with SQLite3DB() as db:
+                self.length = db.execute(sql, params).fetchone()[0]
+        return self.length
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+
+        page = self.page(idx // PAGE_SIZE)
+        if idx % PAGE_SIZE >= len(page):
+            raise IndexError(idx)
+        return page[idx % PAGE_SIZE]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # MultiLine copies and compares its values on every update,
+    # which must not load the rows
+    def __copy__(self):
+        return self
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    __hash__ = object.__hash__
+
+    def page(self, n):
+        if n in self.pages:
+            rows = self.pages.pop(n)
+        else:
+            rows = self.load(n)
+        self.pages[n] = rows
+        while len(self.pages) > PAGE_WINDOW:
+            self.pages.popitem(last = False)
+        return rows
+
+    def load(self, n):
+        if n in self.after:
+            offset = 0
+            after = self.after[n]
+        else:
+            # Jumped ahead, skip forward from the closest page we know of
+            known = max(k for k in self.after if k < n)
+            offset = (n - known) * PAGE_SIZE
+            after = self.after[known]
+
+        sql, params = select_sql(self.cls, self.where, self.order_by,
+                limit = PAGE_SIZE, offset = offset, after = after)
+        with SQLite3DB() as db:
+            db.c.row_factory = self.cls.factory
+            db.c.execute(sql, params)
+            rows = db.c.fetchall()
+
+        if len(rows) == PAGE_SIZE:
+            last = rows[-1]
+            self.after[n + 1] = (getattr(last, self.order_by[0]), last.id)
+        return rows
 
 class IvDB():
     def __init__(self):
         with SQLite3DB() as db:
-            script = ""
-            with open('sql/schema.sql', 'r') as content_file:
-                script = content_file.read()
-            db.c.executescript(script)
-            db.db.commit()
-
-    def listDistributors(self, filter = ''):
+            # A database which is up to date needs neither
+            # the schema files nor a write lock
+            if self.schema_version(db) < len(MIGRATIONS):
+                self.migrate(db)
+
+    def schema_version(self, db):
+        return db.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, db):
+        """ Apply the migrations the database has not seen yet.
+            They all run in one transaction, so a failing migration
+            leaves the database as it was.
+        """
+        # Manage the transaction ourselves, the sqlite3 module
+        # would otherwise commit before each schema change
+        isolation_level = db.db.isolation_level
+        db.db.isolation_level = None
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Someone else might have migrated while we waited for the lock
+                version = self.schema_version(db)
+                for version, filename in enumerate(MIGRATIONS[version:],
+                        version + 1):
+                    for statement in sql_statements(filename):
+                        db.execute(statement)
+                    db.execute("PRAGMA user_version = %d" % version)
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.db.isolation_level = isolation_level
+
+    def query(self, cls, where = (), order_by = ('id',), limit = None,
+            offset = None):
+        """ Select rows of cls.table as cls objects.
+
+            where is a list of (field, op, value) predicates which are
+            AND:ed together, order_by a list of fields where a leading
+            '-' sorts descending. Values are always bound as parameters,
+            so the same kind of query reuses the same prepared statement.
+        """
+        sql, params = select_sql(cls, where, order_by, limit, offset)
         with SQLite3DB() as db:
-            db.c.row_factory = Distributor
-            db.c.execute("""SELECT * FROM distributor %s""" % filter)
-            dist = db.c.fetchall()
-        return dist
+            db.c.row_factory = cls.factory
+            db.c.execute(sql, params)
+            rows = db.c.fetchall()
+        return rows
 
-    def listProducts(self, filter = ''):
-        with SQLite3DB() as db:
-            db.c.row_factory = Product
-            db.c.execute("""SELECT * FROM products %s ORDER BY name""" % filter)
-            products = db.c.fetchall()
-        return products
+    def listDistributors(self, where = (), order_by = ('id',), **kwargs):
+        return self.query(Distributor, where, order_by, **kwargs)
 
-    def listOrders(self, filter = ''):
-        with SQLite3DB() as db:
-            db.c.row_factory = Order
-            db.c.execute("SELECT * FROM orders %s ORDER BY id" % filter)
-            orders = db.c.fetchall()
-        return orders
+    def listProducts(self, where = (), order_by = ('name',), **kwargs):
+        return self.query(Product, where, order_by, **kwargs)
 
-    def listCustomers(self, filter = ''):
-        with SQLite3DB() as db:
-            db.c.row_factory = Customer
-            db.c.execute("SELECT * FROM customer %s" % filter)
-            customers = db.c.fetchall()
-        return customers
+    def browseProducts(self, where = ()):
+        """ Products by name, loaded lazily as they are displayed """
+        return ResultSet(Product, where)
+
+    def listOrders(self, where = (), order_by = ('id',), **kwargs):
+        return self.query(Order, where, order_by, **kwargs)
+
+    def listCustomers(self, where = (), order_by = ('id',), **kwargs):
+        return self.query(Customer, where, order_by, **kwargs)
 
 App = None
 
@@ -325,6 +1027,62 @@ class IvList(npyscreen.MultiLineAction):
     def delete_record(self, *args, **keywords):
         pass
 
+    def update_value(self, value):
+        """ Redraw the lines showing value if they are on screen,
+            instead of the whole list
+        """
+        for i, line in enumerate(self._my_widgets):
+            if getattr(line, 'task', None) not in ('PRINTLINE',
+                    'PRINTLINELASTOFSCREEN'):
+                continue
+            index = self.start_display_at + i
+            try:
+                if self.values[index] is not value:
+                    continue
+            except IndexError:
+                break
+            self._print_line(line, index)
+            line.highlight = index == self.cursor_line and \
+                    bool(self.editing or self.always_show_cursor)
+            line.update(clear = True)
+
+class ScanField(npyscreen.Textfield):
+    """ Input for a barcode scanner. Every code ends with Enter, and is
+        handed to the form's scan() while the field keeps the focus
+    """
+    def set_up_handlers(self):
+        super(ScanField, self).set_up_handlers()
+        self.handlers.update({
+            curses.ascii.NL: self.h_scan,
+            curses.ascii.CR: self.h_scan,
+        })
+
+    def h_scan(self, _input):
+        code = self.value.strip()
+        self.value = ''
+        self.cursor_position = 0
+        if code:
+            self.parent.scan(code)
+
+    def get_and_use_key_press(self):
+        super(ScanField, self).get_and_use_key_press()
+
+        # A scanner types a whole burst of codes at once. Everything
+        # already waiting is handled before the field is drawn again
+        pad = self.parent.curses_pad
+        pad.nodelay(1)
+        try:
+            while self.editing:
+                ch = self._get_ch()
+                if ch == -1:
+                    break
+                self.handle_input(ch)
+        finally:
+            pad.nodelay(0)
+
+class TitleScanField(npyscreen.TitleText):
+    _entry_type = ScanField
+
 class IvListTitle(npyscreen.TitleMultiLine):
     _entry_type = IvList
 
@@ -345,47 +1103,18 @@ class IvListOrderProducts(IvListTitle):
         })
     def increase_amount(self, *args, **keywords):
         op = self.parent.added_products[self.entry_widget.cursor_line]
-        op.count += 1
-
-        for p in self.parent.wProducts.values:
-            if p.id == op.productid:
-                if p.physical_product:
-                    p.stock -= 1
-                    p.updated_stock = True
-                break
-
-        self.parent.update_list()
+        self.parent.change_count(op, op.count + 1)
 
     def decrease_amount(self, *args, **keywords):
         op = self.parent.added_products[self.entry_widget.cursor_line]
-        op.count -= 1
-
-        for p in self.parent.wProducts.values:
-            if p.id == op.productid:
-                if p.physical_product:
-                    p.stock += 1
-                    p.updated_stock = True
-                break
-
-        self.parent.update_list()
+        self.parent.change_count(op, op.count - 1)
 
     def edit_post(self, *args, **keywords):
             self.parent.parentApp.getForm('ORDEREDITPRODUCTFORM').productIdx = self.entry_widget.cursor_line
             self.parent.parentApp.switchForm('ORDEREDITPRODUCTFORM')
 
     def delete_post(self, *args, **keywords):
-        op = self.parent.added_products[self.entry_widget.cursor_line]
-        self.parent.deleted_products.append(op)
-
-        for p in self.parent.wProducts.values:
-            if p.id == op.productid:
-                if p.physical_product:
-                    p.stock += op.count
-                    p.updated_stock = True
-                break
-
-        del self.parent.added_products[self.entry_widget.cursor_line]
-        self.parent.update_list()
+        self.parent.remove_line(self.entry_widget.cursor_line)
 
 class IvListOrderProductsAvailable(IvListTitle):
     def __init__(self, *args, **kwargs):
@@ -396,19 +1125,11 @@ class IvListOrderProductsAvailable(IvListTitle):
 
     def increase_amount(self, *args, **keywords):
         """ Add this product to list of added products """
-
-        self.parent.added_products.append(
-                OrderProduct(self.parent.value.id, self.values[self.entry_widget.cursor_line]))
-        self.parent.update_list()
-
-        # Deduct one from this list
-        self.values[self.entry_widget.cursor_line].stock -= 1
-        self.update()
+        self.parent.add_line(self.values[self.entry_widget.cursor_line])
 
     def actionHighlighted(self, selected, keypress):
         """ Add this product to list of added products """
-        self.parent.added_products += OrderProduct(orderid =
-                self.parent.value.id, product = selected)
+        self.parent.add_line(selected)
 
 class IvListOrders(IvList):
     def delete_record(self, *args, **keywords):
@@ -482,6 +1203,16 @@ class SubActionForm(npyscreen.ActionForm):
     def on_cancel(self):
         self.parentApp.switchFormPrevious()
 
+    def conflict(self):
+        """ self.value was saved by someone else while it was edited here.
+            It is loaded anew, and the form stays open to edit it again
+        """
+        npyscreen.notify_confirm("This was changed by someone else "
+                "meanwhile, and has been reloaded. Your changes were not "
+                "saved.", title = "Conflict")
+        identity_map.forget([self.value])
+        self.value = type(self.value).get(self.value.id)
+
 class ProductEditForm(SubActionForm):
     def create(self):
         self.value = None
@@ -535,9 +1266,9 @@ class ProductEditForm(SubActionForm):
             pass
 
         try:
-            self.value.stock = Decimal(self.wStock.value)
+            stock = Decimal(self.wStock.value)
         except DecimalException:
-            pass
+            stock = self.value.stock
 
         self.value.description =  self.wDescription.value
         self.value.distributor = self.wDistributor.values[self.wDistributor.value[0]][0]
@@ -549,7 +1280,25 @@ class ProductEditForm(SubActionForm):
 
         self.value.upc = self.wUPC.value
         self.value.physical_product = self.wPhysicalProduct.value[0]
-        self.value.save()
+
+        # A changed stock is what was counted. It is recorded as an
+        # adjustment by the difference to the stock in the database,
+        # which includes the orders saved since the list was loaded
+        try:
+            with Session() as session:
+                session.add(self.value)
+                session.flush()
+                if stock != self.value.stock:
+                    current = session.db.execute("SELECT stock FROM products "
+                            "WHERE id = ?", (self.value.id,)).fetchone()[0]
+                    if stock != current:
+                        session.add(StockMovement(productid = self.value.id,
+                            delta = stock - current))
+        except ConflictError:
+            self.conflict()
+            return
+        # What the database holds now, not a change to save
+        object.__setattr__(self.value, 'stock', stock)
         self.parentApp.getForm('PRODUCTFORM').wProductList.update()
         self.parentApp.switchFormPrevious()
 
@@ -562,8 +1311,7 @@ class ProductForm(SubForm):
                 selectForm = 'PRODUCTEDITFORM',
                 display_value = product_fmt_func,
                 name="Products list",
-                scroll_exit=True, values =
-                self.parentApp.db.listProducts()
+                scroll_exit=True, values = []
                 )
 
     def beforeEditing(self):
@@ -574,7 +1322,7 @@ class ProductForm(SubForm):
             self.parentApp.switchFormPrevious()
 
     def update_list(self):
-        self.wProductList.values = self.parentApp.db.listProducts()
+        self.wProductList.values = self.parentApp.db.browseProducts()
         self.wProductList.display()
 
 class OrderEditProductForm(npyscreen.ActionPopup):
@@ -598,22 +1346,12 @@ class OrderEditProductForm(npyscreen.ActionPopup):
         op.comment = self.wComment.value
 
         try:
-            op.price = Decimal(self.wPrice.value)
+            form.change_price(op, Decimal(self.wPrice.value))
         except DecimalException:
             pass
 
         try:
-            new_count = Decimal(self.wAmount.value)
-            if op.count != new_count:
-                # Update stock of product
-                for p in form.wProducts.values:
-                    if p.id == op.productid:
-                        if p.physical_product:
-                            p.stock -= new_count - op.count
-                            p.updated_stock = True
-                        break
-
-                op.count = new_count
+            form.change_count(op, Decimal(self.wAmount.value))
         except DecimalException:
             pass
 
@@ -631,6 +1369,8 @@ class OrderEditForm(SubActionForm):
         self.from_popup = False
         self.added_products = []
         self.deleted_products = []
+        self.changed_products = {}
+        self.total = Decimal(0)
 
         self.wDescription = self.add(npyscreen.TitleText, name="Description:",value="")
         self.wStatus = self.add(npyscreen.TitleSelectOne,
@@ -643,6 +1383,9 @@ class OrderEditForm(SubActionForm):
                 values = self.parentApp.db.listCustomers())
         # Select first entry
         self.wCustomer.entry_widget.h_select('')
+        self.wScan = self.add(TitleScanField, name = "Scan UPC:", value = "")
+        self.wScanned = self.add(npyscreen.TitleFixedText, name = "Scanned:",
+                value = "", editable = False)
         self.wAddedProducts = self.add(IvListOrderProducts,
                 name = "Currently added products:",
                 display_value = order_product_fmt_func,
@@ -660,20 +1403,27 @@ class OrderEditForm(SubActionForm):
                 display_value = product_fmt_func,
                 scroll_exit=True,
                 begin_entry_at = 0,
-                values = self.parentApp.db.listProducts()
+                values = []
                 )
 
     def beforeEditing(self):
         if self.from_popup:
+            # The line and the total were updated by the popup
             self.from_popup = False
-            self.update_list()
             return
 
         if self.value is None:
             self.value = Order()
 
+        # Lines and stock changed here before are loaded anew
+        identity_map.forget(self.changed_products.values())
+        identity_map.forget(self.added_products + self.deleted_products)
+        self.wProducts.values = self.parentApp.db.browseProducts()
+
         self.added_products = self.value.listProducts()
         self.deleted_products = []
+        self.changed_products = {}
+        self.wScanned.value = ""
 
         self.wDescription.value = self.value.description
         self.wStatus.value = self.value.status
@@ -689,38 +1439,133 @@ class OrderEditForm(SubActionForm):
     def update_list(self):
         self.wAddedProducts.values = self.added_products
 
-        # Recalculate total
-        total = Decimal(0)
+        # Recalculate total, after this it is kept up to date by
+        # the methods below as lines change
+        self.total = Decimal(0)
         for p in self.added_products:
-            total = total + (p.price * p.count)
-        self.wTotalSum.value = str(total) + " kr"
+            self.total = self.total + (p.price * p.count)
+        self.show_total()
 
         self.wAddedProducts.display()
         self.wProducts.display()
 
+    def show_total(self):
+        self.wTotalSum.value = str(self.total) + " kr"
+        self.wTotalSum.display()
+
+    def add_line(self, product):
+        op = OrderProduct(self.value.id, product)
+        self.added_products.append(op)
+        self.total += op.price * op.count
+        self.adjust_stock(product.id, -op.count)
+
+        # The list has grown, the lines on screen are redrawn
+        self.wAddedProducts.display()
+        self.show_total()
+
+    def remove_line(self, index):
+        op = self.added_products.pop(index)
+        self.deleted_products.append(op)
+        self.total -= op.price * op.count
+        self.adjust_stock(op.productid, op.count)
+
+        self.wAddedProducts.display()
+        self.show_total()
+
+    def change_count(self, op, count):
+        if count == op.count:
+            return
+        self.total += op.price * (count - op.count)
+        self.adjust_stock(op.productid, op.count - count)
+        op.count = count
+
+        self.wAddedProducts.entry_widget.update_value(op)
+        self.show_total()
+
+    def change_price(self, op, price):
+        if price == op.price:
+            return
+        self.total += (price - op.price) * op.count
+        op.price = price
+
+        self.wAddedProducts.entry_widget.update_value(op)
+        self.show_total()
+
+    def scan(self, code):
+        """ Add one more of the product with this UPC to the order """
+        # Through the index on products.UPC
+        products = self.parentApp.db.query(Product, [('upc', '=', code)],
+                limit = 1)
+        if not products:
+            curses.beep()
+            self.wScanned.value = "Unknown UPC %s" % code
+            self.wScanned.display()
+            return
+
+        product = products[0]
+        for op in self.added_products:
+            if op.productid == product.id:
+                self.change_count(op, op.count + 1)
+                break
+        else:
+            self.add_line(product)
+        self.wScanned.value = product.name
+        self.wScanned.display()
+
+    def adjust_stock(self, productid, delta):
+        """ Show the change in stock of a product while editing. The stock
+            itself is moved when the order lines are saved
+        """
+        p = Product.get(productid)
+        if p is not None and p.physical_product:
+            p.stock += delta
+            self.changed_products[p.id] = p
+            identity_map.keep(p)
+            self.wProducts.entry_widget.update_value(p)
+
     def on_ok(self):
+        # The invoice is rendered in the background once an order is sent
+        sent = (self.value.status != ORDER_SENT and
+                self.wStatus.value[0] == ORDER_SENT)
+
         self.value.description = self.wDescription.value
         self.value.customerid = self.wCustomer.values[self.wCustomer.value[0]][0]
         self.value.status = self.wStatus.value[0]
-        self.value.invoicefile = ''
         self.value.created = 0
-        self.value.save()
 
-        for p in self.added_products:
-            # Was this a new order?
-            if p.orderid == -1:
-                p.orderid = self.value.id
-            p.save()
+        # Everything is written in one transaction
+        try:
+            with Session() as session:
+                session.add(self.value)
+                session.flush()
+
+                for p in self.added_products:
+                    # Was this a new order?
+                    if p.orderid == -1:
+                        p.orderid = self.value.id
+                    session.add(p)
+
+                for p in self.deleted_products:
+                    session.delete(p)
+
+                if sent:
+                    session.add(RenderJob(orderid = self.value.id))
+        except ConflictError:
+            identity_map.forget(self.changed_products.values())
+            self.changed_products = {}
+            self.conflict()
+            return
 
-        for p in self.deleted_products:
-            p.delete()
+        # Load the products anew, with the stock the database calculated
+        identity_map.forget(self.changed_products.values())
+        self.changed_products = {}
 
-        # Check if stock has been modified
-        for p in self.wProducts.values:
-            if getattr(p,'updated_stock',False):
-                p.save()
-                p.updated_stock = False
+        self.parentApp.switchFormPrevious()
 
+    def on_cancel(self):
+        # Stock changes are thrown away, the products are loaded anew
+        identity_map.forget(self.changed_products.values())
+        self.changed_products = {}
         self.parentApp.switchFormPrevious()
 
 class OrderForm(SubForm):
@@ -736,7 +1581,7 @@ class OrderForm(SubForm):
     def beforeEditing(self):
         if self.value is None:
             self.value = 0
-        self.filter = "WHERE status = %d" % self.value
+        self.filter = [('status', '=', self.value)]
 
         self.update_list()
 
@@ -745,7 +1590,7 @@ class OrderForm(SubForm):
             self.parentApp.switchFormPrevious()
 
     def update_list(self):
-        self.wOrderList.values = self.parentApp.db.listOrders(self.filter)
+        self.wOrderList.values = self.parentApp.db.listOrders(where = self.filter)
         self.wOrderList.display()
 
 class CustomerEditForm(SubActionForm):
@@ -777,7 +1622,11 @@ class CustomerEditForm(SubActionForm):
         self.value.address2 = self.wAddress2.value
         self.value.postcode = self.wPostcode.value
         self.value.city = self.wCity.value
-        self.value.save()
+        try:
+            self.value.save()
+        except ConflictError:
+            self.conflict()
+            return
         self.parentApp.switchFormPrevious()
 
 class CustomerForm(SubForm):
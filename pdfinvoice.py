@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+""" Writes invoices directly as PDF, with the layout of invoice.tex.
+
+    Only the standard Helvetica fonts are used, which every PDF viewer
+    has, so nothing needs to be embedded. Pages are written to the file
+    as soon as they are full.
+"""
+import unicodedata
+import zlib
+
+# A4, in points
+PAGE_WIDTH = 595.28
+PAGE_HEIGHT = 841.89
+MARGIN = 56.69          # 2cm
+MARGIN_TOP = 85.04      # 3cm
+
+CERULEAN = (0.06, 0.89, 1.0)
+GRAY = 0.9
+
+SELLER_REFERENCE = u"Elias Norberg"
+PAYMENT_TERMS = u"30 dagar"
+LATE_PAYMENT = [
+    u"Vid betalning efter förfallodagen tillkommer påminnelseavgift om 50 kr samt 10 % dröjsmålsränta.",
+    u"OBS! Vid betalning till BG/PG-konto, var god ange Fakturanummer i meddelandefältet",
+]
+FOOTER = [
+    [(u"Telefon:", u"+46(0)769329328"), (u"Org.nr.", u"821209-7136"),
+        (u"Bankgiro:", u"770-3267")],
+    [(u"Hemsida:", u"http://www.oddbike.se"),
+        (u"VAT/Moms Reg.nr.", u"SE821209713601"),
+        (u"Plusgiro", u"60 57 55-8")],
+    [(u"E-post:", u"faktura@oddbike.se"), (u"SWIFT/BIC:", u"NDEASESS"),
+        (u"", u"")],
+    [(u"", u""), (u"IBAN:", u"SE97 9500 0099 6042 0605 7558")],
+]
+
+# Table columns: (left, right) edges
+COL_ROW = (MARGIN, MARGIN + 28)
+COL_DESCRIPTION = (MARGIN + 34, MARGIN + 34 + 252.3)     # p{8.9cm}
+COL_COUNT = (COL_DESCRIPTION[1], MARGIN + 345)
+COL_PRICE = (COL_COUNT[1], MARGIN + 415)
+COL_AMOUNT = (COL_PRICE[1], PAGE_WIDTH - MARGIN)
+
+FONT_SIZE = 11
+ROW_HEIGHT = 20
+LINE_HEIGHT = 13.6
+FOOTER_TOP = PAGE_HEIGHT - MARGIN - 4 * 11
+
+# Widths of the printable ASCII characters (32-126) in the standard
+# Helvetica AFM files, in 1/1000 of the font size
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333,
+    278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278,
+    584, 584, 584, 556, 1015, 667, 667, 722, 722, 667, 611, 778, 722, 278,
+    500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+    667, 667, 611, 278, 278, 278, 469, 556, 333, 556, 556, 500, 556, 556,
+    278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500,
+    278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333,
+    278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333,
+    584, 584, 584, 611, 975, 722, 722, 722, 722, 667, 611, 778, 722, 278,
+    556, 722, 611, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+    667, 667, 611, 333, 278, 333, 584, 556, 333, 556, 611, 556, 611, 556,
+    333, 611, 611, 278, 278, 556, 278, 889, 611, 611, 611, 611, 389, 556,
+    333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+# Characters beyond ASCII which are not an accented ASCII letter
+EXTRA_WIDTHS = {
+    u' ': (278, 278), u'§': (556, 556), u'°': (400, 400),
+    u'Æ': (1000, 1000), u'Ø': (778, 778), u'ß': (611, 611),
+    u'æ': (889, 889), u'ø': (611, 611), u'×': (584, 584),
+    u'à': (556, 556), u'€': (556, 556), u'–': (556, 556),
+    u'—': (1000, 1000),
+}
+
+try:
+    unichr_ = unichr
+    unicode_ = unicode
+except NameError:
+    unichr_ = chr
+    unicode_ = str
+
+class Font():
+    """ Metrics of one of the standard fonts, with string widths cached """
+    CACHE_SIZE = 10000
+
+    def __init__(self, resource, name, widths, extra):
+        self.resource = resource
+        self.name = name
+        self.widths = dict((unichr_(32 + i), w) for i, w in enumerate(widths))
+        for c, w in EXTRA_WIDTHS.items():
+            self.widths[c] = w[extra]
+        self.cache = {}
+
+    def char_width(self, c):
+        if c not in self.widths:
+            # Accented letters are as wide as the letter itself
+            base = unicodedata.normalize('NFD', c)[0]
+            self.widths[c] = self.widths.get(base, 556)
+        return self.widths[c]
+
+    def width(self, text, size):
+        w = self.cache.get(text)
+        if w is None:
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.clear()
+            w = self.cache[text] = sum(self.char_width(c) for c in text)
+        return w * size / 1000.0
+
+HELVETICA = Font('F1', 'Helvetica', HELVETICA_WIDTHS, 0)
+HELVETICA_BOLD = Font('F2', 'Helvetica-Bold', HELVETICA_BOLD_WIDTHS, 1)
+
+def pdf_string(text):
+    """ PDF string literal in WinAnsiEncoding. The bytes are returned
+        as latin-1 characters, content streams are encoded as latin-1
+    """
+    data = text.encode('cp1252', 'replace').decode('latin-1')
+    return u'(%s)' % data.replace(u'\\', u'\\\\').replace(u'(', u'\\(') \
+            .replace(u')', u'\\)')
+
+class PdfWriter():
+    """ Writes PDF objects to a file as they are created, and the
+        cross-reference table once the document is closed.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+        self.offsets = {}
+        self.next_id = 1
+        self.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+
+    def reserve(self):
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def obj(self, body, id = None):
+        if id is None:
+            id = self.reserve()
+        self.offsets[id] = self.pos
+        self.write(('%d 0 obj\n' % id).encode('ascii'))
+        self.write(body)
+        self.write(b'\nendobj\n')
+        return id
+
+    def stream(self, data):
+        data = zlib.compress(data)
+        return self.obj(('<< /Length %d /Filter /FlateDecode >>\nstream\n'
+            % len(data)).encode('ascii') + data + b'\nendstream')
+
+    def close(self, root):
+        xref = self.pos
+        self.write(('xref\n0 %d\n' % self.next_id).encode('ascii'))
+        self.write(b'0000000000 65535 f \n')
+        for id in range(1, self.next_id):
+            self.write(('%010d 00000 n \n' % self.offsets[id]).encode('ascii'))
+        self.write(('trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (self.next_id, root, xref)).encode('ascii'))
+
+class Page():
+    """ Content of one page. y is measured from the top of the page """
+    def __init__(self):
+        self.ops = []
+
+    def text(self, x, y, text, font = HELVETICA, size = FONT_SIZE):
+        self.ops.append(u'BT /%s %.2f Tf %.2f %.2f Td %s Tj ET' % (
+            font.resource, size, x, PAGE_HEIGHT - y, pdf_string(text)))
+
+    def text_right(self, right, y, text, font = HELVETICA, size = FONT_SIZE):
+        self.text(right - font.width(text, size), y, text, font, size)
+
+    def text_center(self, left, right, y, text, font = HELVETICA,
+            size = FONT_SIZE):
+        self.text((left + right - font.width(text, size)) / 2, y, text,
+                font, size)
+
+    def color(self, r, g, b):
+        self.ops.append(u'%.2f %.2f %.2f rg' % (r, g, b))
+
+    def fill(self, x, y, width, height, gray):
+        self.ops.append(u'q %.2f g %.2f %.2f %.2f %.2f re f Q' % (
+            gray, x, PAGE_HEIGHT - y - height, width, height))
+
+    def hline(self, y, left = MARGIN, right = PAGE_WIDTH - MARGIN):
+        self.ops.append(u'0.4 w %.2f %.2f m %.2f %.2f l S' % (
+            left, PAGE_HEIGHT - y, right, PAGE_HEIGHT - y))
+
+    def content(self):
+        return u'\n'.join(self.ops).encode('latin-1')
+
+def break_word(word, font, size, width):
+    """ Break a word wider than width into pieces which are not """
+    pieces = []
+    piece = u''
+    piece_width = 0
+    for c in word:
+        w = font.char_width(c) * size / 1000.0
+        if piece and piece_width + w > width:
+            pieces.append(piece)
+            piece = u''
+            piece_width = 0
+        piece += c
+        piece_width += w
+    pieces.append(piece)
+    return pieces
+
+def wrap(text, font, size, width):
+    """ Break text into lines no wider than width. Any value is taken
+        as its text, like unicode(name) in the LaTeX source
+    """
+    lines = []
+    line = u''
+    for word in unicode_(text).split(u' '):
+        if font.width(word, size) > width:
+            pieces = break_word(word, font, size, width)
+            if line:
+                lines.append(line)
+            lines.extend(pieces[:-1])
+            line = pieces[-1]
+            continue
+        candidate = line + u' ' + word if line else word
+        if line and font.width(candidate, size) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    lines.append(line)
+    return lines
+
+def money(value):
+    return u'%.2f kr' % value
+
+class InvoiceLayout():
+    """ Lays out an invoice on pages and streams them to a PdfWriter """
+    def __init__(self, writer):
+        self.writer = writer
+        self.pages_id = writer.reserve()
+        self.page_ids = []
+        self.fonts_id = writer.obj((u'<< /F1 << /Type /Font /Subtype /Type1 '
+            u'/BaseFont /Helvetica /Encoding /WinAnsiEncoding >> '
+            u'/F2 << /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold '
+            u'/Encoding /WinAnsiEncoding >> >>').encode('ascii'))
+        self.page = None
+
+    def new_page(self):
+        if self.page is not None:
+            self.finish_page()
+        self.page = Page()
+        self.footer()
+
+    def finish_page(self):
+        content = self.writer.stream(self.page.content())
+        self.page_ids.append(self.writer.obj((u'<< /Type /Page /Parent %d 0 R '
+            u'/MediaBox [0 0 %.2f %.2f] /Resources << /Font %d 0 R >> '
+            u'/Contents %d 0 R >>' % (self.pages_id, PAGE_WIDTH, PAGE_HEIGHT,
+                self.fonts_id, content)).encode('ascii')))
+        self.page = None
+
+    def close(self):
+        self.finish_page()
+        self.writer.obj((u'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            u' '.join(u'%d 0 R' % id for id in self.page_ids),
+            len(self.page_ids))).encode('ascii'), self.pages_id)
+        root = self.writer.obj((u'<< /Type /Catalog /Pages %d 0 R >>'
+            % self.pages_id).encode('ascii'))
+        self.writer.close(root)
+
+    def footer(self):
+        # Labels are right aligned against their values
+        columns = [MARGIN + 45, MARGIN + 235, MARGIN + 375]
+        y = FOOTER_TOP
+        self.page.hline(y - 9)
+        for row in FOOTER:
+            for x, (label, value) in zip(columns, row):
+                self.page.text_right(x, y, label, HELVETICA_BOLD, 9)
+                self.page.text(x + 5, y, value, HELVETICA, 9)
+            y += 11
+
+    def heading(self, invoice):
+        page = self.page
+        page.color(*CERULEAN)
+        page.text(MARGIN, MARGIN_TOP, u'oddbike', HELVETICA_BOLD, 48)
+        page.color(0, 0, 0)
+
+        x = MARGIN + 230
+        page.text(x, MARGIN_TOP - 20, u'Fakturanummer:')
+        page.text(x + 115, MARGIN_TOP - 20, invoice['number'])
+        page.text(x, MARGIN_TOP - 6, u'Fakturadatum:')
+        page.text(x + 115, MARGIN_TOP - 6, invoice['date'])
+
+        y = MARGIN_TOP + 50
+        page.text(MARGIN, y, u'Fakturaadress:', HELVETICA_BOLD)
+        y += 22
+        customer = invoice['customer']
+        postal = u'  '.join(v for v in (customer.get('postcode'),
+            customer.get('city')) if v)
+        for value in (customer.get('name'), customer.get('address1'),
+                customer.get('address2'), postal):
+            if value:
+                page.text(MARGIN, y, value)
+                y += LINE_HEIGHT
+
+        y_ref = MARGIN_TOP + 50
+        for label, value in ((u'Er referens', customer.get('reference')),
+                (u'Vår referens', SELLER_REFERENCE),
+                (u'Betalningsvilkor', PAYMENT_TERMS)):
+            page.text(x, y_ref, label, HELVETICA_BOLD)
+            page.text(x + 115, y_ref, value or u'')
+            y_ref += LINE_HEIGHT
+
+        return max(y, y_ref) + 50
+
+    def table_header(self, y):
+        page = self.page
+        page.fill(MARGIN, y, PAGE_WIDTH - 2 * MARGIN, ROW_HEIGHT, GRAY)
+        baseline = y + 13
+        page.text_center(COL_ROW[0], COL_ROW[1], baseline, u'Rad',
+                HELVETICA_BOLD, 9)
+        page.text(COL_DESCRIPTION[0], baseline, u'Beskrivning',
+                HELVETICA_BOLD, 9)
+        page.text_right(COL_COUNT[1], baseline, u'Antal', HELVETICA_BOLD, 9)
+        page.text_right(COL_PRICE[1], baseline, u'à-pris', HELVETICA_BOLD, 9)
+        page.text_right(COL_AMOUNT[1], baseline, u'Belopp (SEK)',
+                HELVETICA_BOLD, 9)
+        y += ROW_HEIGHT
+        page.hline(y)
+        return y + 4
+
+    def write(self, invoice):
+        """ invoice is a dict with number, date, customer (a dict),
+            lines (an iterable of (description, price, count, line total)),
+            and total and vat as functions, which are called once all
+            lines have been written
+        """
+        self.new_page()
+        y = self.table_header(self.heading(invoice))
+        bottom = FOOTER_TOP - 30
+
+        for row, (description, price, count, line_total) in enumerate(
+                invoice['lines'], 1):
+            text = wrap(description, HELVETICA, FONT_SIZE,
+                    COL_DESCRIPTION[1] - COL_DESCRIPTION[0])
+            height = ROW_HEIGHT + (len(text) - 1) * LINE_HEIGHT
+            if y + height > bottom:
+                self.new_page()
+                y = self.table_header(MARGIN_TOP)
+
+            baseline = y + 14
+            page = self.page
+            page.text_center(COL_ROW[0], COL_ROW[1], baseline, u'%d' % row)
+            for i, line in enumerate(text):
+                page.text(COL_DESCRIPTION[0], baseline + i * LINE_HEIGHT, line)
+            page.text_right(COL_COUNT[1], baseline, u'%.2f' % count)
+            page.text_right(COL_PRICE[1], baseline, money(price))
+            page.text_right(COL_AMOUNT[1], baseline, money(line_total))
+            y += height
+
+        # Sums and payment notes need to stay together
+        if y + 140 > bottom:
+            self.new_page()
+            y = MARGIN_TOP
+        y += 55
+        page = self.page
+        page.hline(y)
+        for label, value in ((u'Att betala', invoice['total']()),
+                (u'Varav moms (25 %)', invoice['vat']())):
+            y += ROW_HEIGHT
+            page.text_right(COL_PRICE[1] - 8, y - 6, label, HELVETICA_BOLD)
+            page.text_right(COL_AMOUNT[1], y - 6, money(value))
+        page.hline(y + 4)
+
+        y += 24
+        for line in LATE_PAYMENT:
+            page.text(MARGIN, y, line, HELVETICA, 9)
+            y += 11
+
+        self.close()
+
+def write_invoice(f, invoice):
+    """ Write the invoice as PDF to the binary file f """
+    InvoiceLayout(PdfWriter(f)).write(invoice)
@@ -0,0 +1,5 @@
+CREATE INDEX IF NOT EXISTS order_products_orderId ON order_products (orderId);
+CREATE INDEX IF NOT EXISTS order_products_productId ON order_products (productId);
+CREATE INDEX IF NOT EXISTS orders_status_id ON orders (status, id);
+CREATE INDEX IF NOT EXISTS products_name ON products (name);
+CREATE INDEX IF NOT EXISTS products_UPC ON products (UPC);
@@ -0,0 +1,4 @@
+-- Invoices for gen-pdf.py --daemon to render.
+-- status: 0 - queued, 1 - rendering, 2 - done, 3 - failed
+CREATE TABLE IF NOT EXISTS render_jobs (id INTEGER PRIMARY KEY, orderId INTEGER NOT NULL, status INTEGER NOT NULL DEFAULT 0, error TEXT, created datetime DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX IF NOT EXISTS render_jobs_status_id ON render_jobs (status, id);
@@ -0,0 +1,7 @@
+-- Every change of stock, products.stock is the sum of its movements.
+-- Movements of order lines refer to them by orderProductId.
+CREATE TABLE IF NOT EXISTS stock_movements (id INTEGER PRIMARY KEY, productId INTEGER NOT NULL, orderProductId INTEGER, delta DECIMAL NOT NULL, created datetime DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX IF NOT EXISTS stock_movements_productId ON stock_movements (productId);
+CREATE INDEX IF NOT EXISTS stock_movements_orderProductId ON stock_movements (orderProductId);
+-- Opening balance of the stock there was before
+INSERT INTO stock_movements (productId, delta) SELECT id, stock FROM products WHERE stock != 0;
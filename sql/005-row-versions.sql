@@ -0,0 +1,4 @@
+-- Row versions for optimistic locking, every update increments them
+ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE customer ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
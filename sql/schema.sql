@@ -1,4 +1,3 @@
-BEGIN TRANSACTION;
 CREATE TABLE IF NOT EXISTS customer (id INTEGER PRIMARY KEY, name TEXT, reference TEXT, postcode TEXT, city TEXT, address1 TEXT, address2 TEXT);
 INSERT OR IGNORE INTO customer VALUES(1,'Standardkund','-',NULL,NULL,NULL,NULL);
 CREATE TABLE IF NOT EXISTS order_products (id INTEGER PRIMARY KEY, price DECIMAL, orderId INTEGER, productId INTEGER, comment TEXT, count DECIMAL);
@@ -7,5 +6,3 @@ CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, name TEXT, descript
 CREATE TABLE IF NOT EXISTS distributor (id INTEGER PRIMARY KEY, name TEXT);
 INSERT OR IGNORE INTO distributor VALUES(1,'Skeppshult');
 INSERT OR IGNORE INTO distributor VALUES(2,'Shimano');
-
-COMMIT;
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Checks of the TeX escaping in gen-pdf.py. Run with
+        python test_escape.py
+"""
+import imp
+import os
+import random
+import re
+import unittest
+
+gen_pdf = imp.load_source('gen_pdf',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen-pdf.py'))
+
+SPECIALS = gen_pdf.TEX_SPECIALS
+# Escaped text is made of replacements and characters which are not special
+TOKEN = re.compile(u'|'.join(re.escape(r) for r in
+    sorted(SPECIALS.values(), key = len, reverse = True)) + u'|.', re.S)
+UNESCAPE = dict((r, c) for c, r in SPECIALS.items())
+
+def unescape(text):
+    """ The text escape() was given, fails if anything is left unescaped """
+    chars = []
+    for token in TOKEN.findall(text):
+        if token in SPECIALS:
+            raise AssertionError("%r is not escaped in %r" % (token, text))
+        chars.append(UNESCAPE.get(token, token))
+    return u''.join(chars)
+
+class EscapeTest(unittest.TestCase):
+    def test_every_special(self):
+        for c, replacement in SPECIALS.items():
+            self.assertEqual(gen_pdf.escape(c), replacement)
+            self.assertEqual(gen_pdf.escape(u'a%sb' % c),
+                    u'a%sb' % replacement)
+
+    def test_plain_text(self):
+        text = u'Cykelpump 28 tum – åäö ÅÄÖ 12.50'
+        self.assertEqual(gen_pdf.escape(text), text)
+
+    def test_fuzz(self):
+        rnd = random.Random(19)
+        alphabet = u''.join(SPECIALS) + u'ab åé1 \n\t€'
+        for n in range(5000):
+            text = u''.join(rnd.choice(alphabet)
+                    for i in range(rnd.randint(0, 20)))
+            self.assertEqual(unescape(gen_pdf.escape(text)), text)
+
+    def test_line_break_argument(self):
+        # Customer fields end in \\, a following field must not be read
+        # as its optional [argument] or * form
+        rnd = random.Random(20)
+        fields = [u'[c/o Foo]', u'*Lager', u']x', u'Storgatan 1']
+        for n in range(500):
+            rnd.shuffle(fields)
+            text = u''.join(gen_pdf.escape(f) + u'\\\\\n' for f in fields)
+            self.assertFalse(re.search(u'\\\\\\\\\\s*[\\[*]', text), text)
+
+if __name__ == '__main__':
+    unittest.main()